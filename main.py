@@ -1,32 +1,139 @@
 import os
+import logging
 import yaml
 import boto3
+import boto3.s3.transfer
 import botocore
+import botocore.config
 import requests
+import requests.adapters
+import urllib3.util.retry
 import io
 import gzip
+import concurrent.futures
+import itertools
+import threading
+
+# Use the libyaml-backed loader and dumper when PyYAML was built with them.
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+# zstandard is only needed by wikis configured with 'compression: zstd'.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 assert 'CONFIG_BUCKET' in os.environ
 assert 'CONFIG_KEY' in os.environ
 assert 'ADMIN_EMAIL' in os.environ
 
+# Progress is logged at DEBUG level, which is skipped (formatting included)
+# unless LOG_LEVEL asks for it.
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'WARNING'))
+
 req_headers = {
     'From': os.environ['ADMIN_EMAIL']
 }
 
-s3 = boto3.client('s3')
+# All MediaWiki API requests go through one session so that connections are
+# kept alive and reused. The queries only read from the wiki, so they are
+# safe to retry even though they are sent as POST requests.
+session = requests.Session()
+session.headers.update(req_headers)
+adapter = requests.adapters.HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=urllib3.util.retry.Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=None,
+        raise_on_status=False
+    )
+)
+session.mount('https://', adapter)
+session.mount('http://', adapter)
 
-def get_config():
-    """Downloads the configuration file from S3."""
-    r = s3.get_object(
-        Bucket=os.environ['CONFIG_BUCKET'],
-        Key=os.environ['CONFIG_KEY']
+# The S3 client is shared between the worker threads, so give its connection
+# pool enough room for all of them. Each page worker may have several content
+# uploads in flight at once.
+max_workers = 16
+upload_workers = 4
+s3 = boto3.client(
+    's3',
+    config=botocore.config.Config(
+        max_pool_connections=max_workers * (upload_workers + 1)
     )
-    return yaml.safe_load(r['Body'].read().decode())
+)
+
+# The most revisions whose content MediaWiki returns to anonymous clients in a
+# single query.
+revids_per_query = 50
+
+# The most revisions MediaWiki lists to anonymous clients in a single query.
+revisions_per_listing = 500
+
+# How much content (in characters, which for wikitext is close to bytes) each
+# page worker may have waiting to be uploaded. Along with the API response
+# being consumed, which the wiki caps at $wgAPIMaxResultSize (8 MiB by
+# default), and the encoded and compressed copies made while uploading, a
+# worker holds a few tens of MiB of content at most. The function is assumed
+# to have at least 1 GiB of memory for max_workers of them; lower max_workers
+# if it has less.
+max_pending_upload = 8 * 1024 * 1024
+
+# Large content objects are uploaded in parts, several at a time. Anything
+# below the threshold still goes out as a single PUT.
+transfer_config = boto3.s3.transfer.TransferConfig(
+    multipart_threshold=5 * 1024 * 1024,
+    multipart_chunksize=5 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True
+)
+
+# The parsed configuration is kept across warm invocations and only downloaded
+# again once its ETag changes.
+config_cache = {
+    'etag': None,
+    'value': None
+}
+
+def get_config():
+    """Downloads the configuration file from S3, if it has changed."""
+    req_params = {
+        'Bucket': os.environ['CONFIG_BUCKET'],
+        'Key': os.environ['CONFIG_KEY']
+    }
+    if config_cache['etag'] is not None:
+        req_params['IfNoneMatch'] = config_cache['etag']
+    try:
+        r = s3.get_object(**req_params)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == '304':
+            return config_cache['value']
+        else:
+            raise
+    config_cache['value'] = yaml.load(r['Body'], Loader=SafeLoader)
+    config_cache['etag'] = r['ETag']
+    return config_cache['value']
 
 class WikiError(Exception):
     pass
 
+# The fields required of the page and revision entries in a history listing.
+page_keys = frozenset(('pageid', 'title', 'fullurl', 'revisions'))
+revision_keys = frozenset(('revid', 'parentid', 'user', 'timestamp', 'comment'))
+
+def check_keys(value, keys):
+    """Raises WikiError if any of the given keys are missing from a dict."""
+    missing = keys - value.keys()
+    if missing:
+        raise WikiError('missing keys: {:s}'.format(', '.join(sorted(missing))))
+
 def mwapi_query(endpoint, params):
     """Runs a 'query' request against the given MediaWiki API endpoint."""
 
@@ -35,18 +142,15 @@ def mwapi_query(endpoint, params):
     base_params['action'] = 'query'
     base_params['format'] = 'json'
     base_params['rawcontinue'] = ''
-    base_params['maxlag'] = '1'
+    base_params['maxlag'] = '5'
 
     # Start with the initial "query-continue" parameters as empty.
     continue_params = {}
 
     # Repeatedly make the request until there are no remaining continues.
     while True:
-        current_params = base_params.copy()
-        current_params.update(continue_params)
-
         # Make the request and parse the response.
-        r = requests.post(endpoint, params=current_params, headers=req_headers)
+        r = session.post(endpoint, params={**base_params, **continue_params})
         r.raise_for_status()
         j = r.json()
 
@@ -66,14 +170,15 @@ def mwapi_query(endpoint, params):
         # Handle query continuation. This is done using the old rawcontinue
         # format for compatibility with older wikis (e.g. Wikia).
         if 'query-continue' in j:
-            continue_params = {}
-            for k1 in j['query-continue']:
-                for k2 in j['query-continue'][k1]:
-                    if not k2.startswith('g'):
-                        continue_params[k2] = j['query-continue'][k1][k2]
+            modules = j['query-continue'].values()
+            continue_params = {
+                k: v for inner in modules for k, v in inner.items()
+                if not k.startswith('g')
+            }
             if not continue_params:
-                for k in j['query-continue']:
-                    continue_params.update(j['query-continue'][k])
+                continue_params = {
+                    k: v for inner in modules for k, v in inner.items()
+                }
             continue
         else:
             break
@@ -82,11 +187,62 @@ def lambda_handler(event, context):
     """Entry point for AWS Lambda."""
     config = get_config()
     assert 'wikis' in config
+
+    # Each page is stored under its own prefix, so the pages can be walked
+    # independently of one another, and each is handed to a worker as soon as
+    # it is listed. The first failure of a page stops the listing, cancels any
+    # pages not yet started and is re-raised here. Should listing a wiki fail
+    # instead, the pages already handed out are still walked, and any of
+    # their failures logged, before the listing error propagates.
+    page_failed = threading.Event()
+    def check_page(future):
+        if not future.cancelled() and future.exception() is not None:
+            page_failed.set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = {}
+        try:
+            for wiki, pageid, revid in list_pages(config):
+                if page_failed.is_set():
+                    break
+                future = executor.submit(handle_page, wiki, pageid, revid)
+                future.add_done_callback(check_page)
+                futures[future] = pageid
+        except Exception:
+            concurrent.futures.wait(futures)
+            for future, pageid in futures.items():
+                if future.exception() is not None:
+                    logger.error(
+                        'Failed to handle page %d',
+                        pageid,
+                        exc_info=future.exception()
+                    )
+            raise
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+def list_pages(config):
+    """Lists the latest revision of every page in the configured sources.
+
+    Yields a (wiki, pageid, revid) tuple for each page.
+    """
+    # Sources may overlap, so each page is only listed once per invocation,
+    # even if another source listed it at a newer revision (which is then
+    # picked up on the next run). Pages are identified by where they are
+    # stored rather than by which wiki entry listed them.
+    seen = set()
     for wiki in config['wikis']:
         assert 'api' in wiki
         assert 's3_bucket' in wiki
         assert 's3_prefix' in wiki
         assert 'sources' in wiki
+        assert wiki.get('compression', 'gzip') in content_suffixes
+        if wiki.get('compression') == 'zstd':
+            assert zstandard is not None
         for source in wiki['sources']:
             params = { 'prop': 'revisions', 'rvprop': 'ids' }
             params.update(source)
@@ -98,7 +254,27 @@ def lambda_handler(event, context):
                     assert len(page['revisions']) == 1
                     revision = page['revisions'][0]
                     assert 'revid' in revision
-                    handle_revision(wiki, page['pageid'], revision['revid'])
+                    seen_key = (
+                        wiki['s3_bucket'],
+                        wiki['s3_prefix'],
+                        page['pageid']
+                    )
+                    if seen_key in seen:
+                        continue
+                    seen.add(seen_key)
+                    yield wiki, page['pageid'], revision['revid']
+
+def handle_page(wiki, pageid, revid):
+    """Adds a page's latest revision (and its ancestors) to S3."""
+    # The latest revision is usually stored already, which a single HEAD
+    # settles. The prefix is only listed when the ancestors must be walked.
+    if s3_key_exists(
+        wiki['s3_bucket'],
+        s3_key_for_revision_metadata(wiki, pageid, revid)
+    ):
+        return
+    known_keys = list_existing_revision_keys(wiki, pageid)
+    handle_revision(wiki, pageid, revid, known_keys)
 
 def s3_key_exists(bucket, key):
     """Checks if a key exists in an S3 bucket."""
@@ -106,140 +282,279 @@ def s3_key_exists(bucket, key):
         s3.head_object(Bucket=bucket, Key=key)
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == '404':
-            print('[FAIL] HEAD on S3: ({:s}): {:s}'.format(bucket, key))
+            logger.debug('[FAIL] HEAD on S3: (%s): %s', bucket, key)
             return False
         else:
             raise
-    print('[ OK ] HEAD on S3: ({:s}): {:s}'.format(bucket, key))
+    logger.debug('[ OK ] HEAD on S3: (%s): %s', bucket, key)
     return True
 
+def list_existing_revision_keys(wiki, pageid):
+    """Lists the keys of all objects already stored on S3 for a page."""
+    bucket = wiki['s3_bucket']
+    prefix = f"{wiki['s3_prefix']}page_{pageid:08d}/"
+    keys = set()
+    paginator = s3.get_paginator('list_objects_v2')
+    for result in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in result.get('Contents', []):
+            keys.add(obj['Key'])
+    logger.debug(
+        '[ OK ] LIST on S3: (%s): %s (%d keys)',
+        bucket,
+        prefix,
+        len(keys)
+    )
+    return keys
+
+# File extensions for content objects, by compression format.
+content_suffixes = {
+    'gzip': 'gz',
+    'zstd': 'zst'
+}
+
 def s3_key_for_revision_metadata(wiki, pageid, revid):
     """Computes the key for the S3 object storing metadata about a revision."""
-    return '{:s}page_{:08d}/rev_{:08d}.yaml'.format(
-        wiki['s3_prefix'],
-        pageid,
-        revid
-    )
+    return f"{wiki['s3_prefix']}page_{pageid:08d}/rev_{revid:08d}.yaml"
 
 def s3_key_for_revision_content(wiki, pageid, revid):
-    """Computes the key for the S3 object storing gzipped revision content."""
-    return '{:s}page_{:08d}/rev_{:08d}_data.gz'.format(
-        wiki['s3_prefix'],
-        pageid,
-        revid
-    )
-
-def s3_key_for_revision_metadata_exists(wiki, pageid, revid):
-    """Checks if a revision's metadata object exists on S3."""
-    return s3_key_exists(
-        wiki['s3_bucket'],
-        s3_key_for_revision_metadata(wiki, pageid, revid)
-    )
+    """Computes the key for the S3 object storing compressed revision content.
 
-def s3_key_for_revision_content_exists(wiki, pageid, revid):
-    """Checks if a revision's gzipped content object exists on S3."""
-    return s3_key_exists(
-        wiki['s3_bucket'],
-        s3_key_for_revision_content(wiki, pageid, revid)
-    )
+    The extension depends on the wiki's configured compression format, which
+    defaults to gzip so that existing objects continue to be recognized.
+    """
+    suffix = content_suffixes[wiki.get('compression', 'gzip')]
+    return f"{wiki['s3_prefix']}page_{pageid:08d}/rev_{revid:08d}_data.{suffix}"
 
 def s3_put_revision_metadata(wiki, pageid, revid, value):
     """Puts the given value in YAML format as the metadata object on S3."""
     bucket = wiki['s3_bucket']
     key = s3_key_for_revision_metadata(wiki, pageid, revid)
-    body = yaml.dump(value, default_flow_style=False)
+    body = yaml.dump(value, Dumper=SafeDumper, default_flow_style=False)
     s3.put_object(
         Bucket=bucket,
         Key=key,
         Body=body
     )
-    print('[ OK ] PUT on S3: ({:s}): {:s}'.format(bucket, key))
-    print(body)
+    logger.debug('[ OK ] PUT on S3: (%s): %s\n%s', bucket, key, body)
 
 def s3_put_revision_content(wiki, pageid, revid, content):
-    """Gzips the given content and puts it as the content object on S3."""
+    """Compresses the given content and puts it as the content object on S3."""
     bucket = wiki['s3_bucket']
     key = s3_key_for_revision_content(wiki, pageid, revid)
-    stream = io.BytesIO()
-    stream_gz = gzip.GzipFile(None, 'wb', 9, stream)
-    stream_gz.write(content.encode())
-    stream_gz.close()
-    s3.put_object(
+    if wiki.get('compression') == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=3, threads=-1)
+        body = compressor.compress(content.encode())
+    else:
+        body = gzip.compress(content.encode(), compresslevel=6)
+    # Both compression format names are also valid HTTP content codings, so
+    # clients which accept them can have the content decoded transparently.
+    s3.upload_fileobj(
+        Fileobj=io.BytesIO(body),
         Bucket=bucket,
         Key=key,
-        Body=stream.getvalue()
+        ExtraArgs={
+            'ContentEncoding': wiki.get('compression', 'gzip'),
+            'ContentType': 'text/plain; charset=utf-8'
+        },
+        Config=transfer_config
     )
-    print('[ OK ] PUT on S3: ({:s}): {:s}'.format(bucket, key))
+    logger.debug('[ OK ] PUT on S3: (%s): %s', bucket, key)
+
+def revision_is_stored(wiki, pageid, revid, known_keys):
+    """Checks if a revision's metadata object is among the known keys."""
+    if revid == 0:
+        return True
+    return s3_key_for_revision_metadata(wiki, pageid, revid) in known_keys
+
+def result_page(result, pageid):
+    """Returns a page's entry from a query result about that page alone."""
+    pages = result.get('pages', {})
+    if (list(pages) != [str(pageid)]
+            or pages[str(pageid)].get('pageid') != pageid):
+        raise WikiError('expected only page {:d} in result'.format(pageid))
+    return pages[str(pageid)]
+
+def revision_content(wiki, revision):
+    """Extracts the content of the main slot from a revision entry."""
+    if 'slots' in wiki:
+        content = revision.get('slots', {}).get('main', {}).get('*')
+    else:
+        content = revision.get('*')
+    if content is None:
+        raise WikiError('no content in revision {}'.format(revision['revid']))
+    return content
+
+def walk_revision_history(wiki, pageid, revid, known_keys):
+    """Collects the metadata of a revision and its unstored ancestors.
+
+    The page's history is listed starting at the given revision and going back
+    in time, and the chain of parent revisions is followed through it until
+    reaching one which has already been stored. Usually only the given
+    revision is new, so the first request asks for that revision alone, along
+    with its content if needed. Each later request resumes at the next needed
+    ancestor and asks for twice as many revisions as the last, without their
+    content.
+
+    Returns the metadata ordered from the given revision to its most distant
+    unstored ancestor, and a dict mapping revids to any content fetched.
+    """
+    revisions = []
+    contents = {}
+    rvlimit = 1
+    while True:
+        req_params = {
+            'prop': 'revisions|info',
+            'rvprop': 'ids|user|timestamp|comment',
+            'inprop': 'url',
+            'pageids': pageid,
+            'rvstartid': revid,
+            'rvdir': 'older',
+            'rvlimit': rvlimit
+        }
+        need_content = not revisions and (
+            s3_key_for_revision_content(wiki, pageid, revid) not in known_keys
+        )
+        if need_content:
+            req_params['rvprop'] += '|content'
+            if 'slots' in wiki:
+                req_params['rvslots'] = wiki['slots']
+        result = next(mwapi_query(wiki['api'], req_params))
+        page = result_page(result, pageid)
+        check_keys(page, page_keys)
+        walked = len(revisions)
+        for revision in page['revisions']:
+            if revision.get('revid') != revid:
+                continue
+            check_keys(revision, revision_keys)
+            if need_content:
+                contents[revid] = revision_content(wiki, revision)
+            revisions.append({
+                'pageid': page['pageid'],
+                'title': page['title'],
+                'url': page['fullurl'],
+                'revid': revid,
+                'parentid': revision['parentid'],
+                'user': revision['user'],
+                'timestamp': revision['timestamp'],
+                'comment': revision['comment']
+            })
+            revid = revision['parentid']
+            if revision_is_stored(wiki, pageid, revid, known_keys):
+                return revisions, contents
+        if len(revisions) == walked:
+            raise WikiError(
+                'revision {:d} not found in history of page {:d}'.format(
+                    revid,
+                    pageid
+                )
+            )
+        rvlimit = min(rvlimit * 2, revisions_per_listing)
+
+def fetch_revision_contents(wiki, pageid, revids):
+    """Downloads the content of the given revisions of a page.
+
+    The revisions are requested in batches. The wiki may split a batch over
+    several responses, and the content from each response is yielded as a
+    dict mapping revids to their content.
+    """
+    for i in range(0, len(revids), revids_per_query):
+        batch = revids[i:i + revids_per_query]
+        req_params = {
+            'prop': 'revisions',
+            'rvprop': 'ids|content',
+            'revids': '|'.join(str(revid) for revid in batch)
+        }
+        if 'slots' in wiki:
+            req_params['rvslots'] = wiki['slots']
+        received = set()
+        for result in mwapi_query(wiki['api'], req_params):
+            page = result_page(result, pageid)
+            contents = {}
+            for revision in page.get('revisions', []):
+                if revision.get('revid') not in batch:
+                    raise WikiError(
+                        'unexpected revision {}'.format(revision.get('revid'))
+                    )
+                contents[revision['revid']] = revision_content(wiki, revision)
+            received.update(contents)
+            yield contents
+        missing = set(batch) - received
+        if missing:
+            raise WikiError('no content returned for revisions: {:s}'.format(
+                ', '.join(str(revid) for revid in sorted(missing))
+            ))
 
-def handle_revision(wiki, pageid, revid):
+def handle_revision(wiki, pageid, revid, known_keys):
     """Adds a revision (and its ancestors) to S3.
     
     If an object with the revision's key already exists in the S3 bucket, it is
     not downloaded or added, and all of its ancestors are excluded from
-    consideration entirely.
+    consideration entirely. Existence is checked against known_keys, the set
+    of keys listed under the page's prefix, which is updated as objects are
+    added.
 
     The ancestral revisions are added before this revision, and those ones are
     added most-ancestral to least. This ensures that, should a latter S3 PUT
     operation fail, all of the revisions ancestral to that one have already
     been stored and thus it is acceptable to exclude them from download later.
     """
-    if revid == 0:
-        return
-    if s3_key_for_revision_metadata_exists(wiki, pageid, revid):
+    if revision_is_stored(wiki, pageid, revid, known_keys):
         return
-    req_params = {
-        'prop': 'revisions|info',
-        'rvprop': 'ids|user|timestamp|comment',
-        'inprop': 'url',
-        'revids' : revid
-    }
-    need_content = not s3_key_for_revision_content_exists(wiki, pageid, revid)
-    if need_content:
-        req_params['rvprop'] += '|content'
-        if 'slots' in wiki:
-            req_params['rvslots'] = wiki['slots']
-    result = next(mwapi_query(
-        wiki['api'],
-        req_params
-    ))
-    assert 'pages' in result
-    assert str(pageid) in result['pages']
-    assert len(result['pages']) == 1
-    page = result['pages'][str(pageid)]
-    assert 'pageid' in page
-    assert page['pageid'] == pageid
-    assert 'title' in page
-    assert 'fullurl' in page
-    assert 'revisions' in page
-    assert len(page['revisions']) == 1
-    revision = page['revisions'][0]
-    assert 'revid' in revision
-    assert revision['revid'] == revid
-    assert 'parentid' in revision
-    parentid = revision['parentid']
-    assert 'user' in revision
-    assert 'timestamp' in revision
-    assert 'comment' in revision
-    if need_content:
-        if 'slots' in wiki:
-            assert 'main' in revision['slots']
-            assert '*' in revision['slots']['main']
-            content = revision['slots']['main']['*']
-        else:
-            assert '*' in revision
-            content = revision['*']
-        s3_put_revision_content(wiki, pageid, revid, content)
-    handle_revision(wiki, pageid, revision['parentid'])
-    s3_put_revision_metadata(wiki, pageid, revid, {
-        'pageid': page['pageid'],
-        'title': page['title'],
-        'url': page['fullurl'],
-        'revid': revid,
-        'parentid': parentid,
-        'user': revision['user'],
-        'timestamp': revision['timestamp'],
-        'comment': revision['comment']
-    })
+    pending, walk_contents = walk_revision_history(
+        wiki,
+        pageid,
+        revid,
+        known_keys
+    )
+
+    # Content objects are not subject to the ordering rule above, so they are
+    # uploaded in the background as soon as they have been downloaded. Any
+    # content which came with the history walk is uploaded first.
+    need_content = [
+        value['revid'] for value in pending
+        if value['revid'] not in walk_contents
+        and s3_key_for_revision_content(wiki, pageid, value['revid'])
+            not in known_keys
+    ]
+    uploads = {}
+    def finish_uploads():
+        for content_key, upload in uploads.items():
+            upload.result()
+            known_keys.add(content_key)
+        uploads.clear()
+    with concurrent.futures.ThreadPoolExecutor(upload_workers) as executor:
+        pending_upload = 0
+        for contents in itertools.chain(
+            [walk_contents],
+            fetch_revision_contents(wiki, pageid, need_content)
+        ):
+            for revid, content in contents.items():
+                # Wait for the queued uploads to finish rather than holding
+                # more than max_pending_upload of content at once.
+                size = len(content)
+                if uploads and pending_upload + size > max_pending_upload:
+                    finish_uploads()
+                    pending_upload = 0
+                pending_upload += size
+                content_key = s3_key_for_revision_content(wiki, pageid, revid)
+                uploads[content_key] = executor.submit(
+                    s3_put_revision_content,
+                    wiki,
+                    pageid,
+                    revid,
+                    content
+                )
+
+        # Every content object must be stored before any metadata is.
+        finish_uploads()
+
+    # Store the metadata most-ancestral first.
+    for value in reversed(pending):
+        s3_put_revision_metadata(wiki, pageid, value['revid'], value)
+        known_keys.add(
+            s3_key_for_revision_metadata(wiki, pageid, value['revid'])
+        )
 
 if __name__ == "__main__":
+    logging.basicConfig()
     lambda_handler(None, None)
@@ -1,7 +1,17 @@
 import os
+import logging
 import yaml
 import boto3
 import requests
+import requests.adapters
+import urllib3.util.retry
+import concurrent.futures
+
+# Use the libyaml-backed loader when PyYAML was built with it.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 assert 'DISCORD_WEBHOOK' in os.environ
 assert 'ADMIN_EMAIL' in os.environ
@@ -10,24 +20,94 @@ req_headers = {
     'From': os.environ['ADMIN_EMAIL']
 }
 
+# The webhook is called through one session so that the connection is kept
+# alive across warm invocations. Only rate-limited responses and failures to
+# connect are retried, as any other failure (including errors reading the
+# response) may still have posted the message.
+session = requests.Session()
+session.headers.update(req_headers)
+adapter = requests.adapters.HTTPAdapter(
+    max_retries=urllib3.util.retry.Retry(
+        total=5,
+        connect=5,
+        read=False,
+        other=0,
+        backoff_factor=0.3,
+        status_forcelist=[429],
+        allowed_methods=None,
+        raise_on_status=False
+    )
+)
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
 s3 = boto3.client('s3')
 
+logger = logging.getLogger(__name__)
+
+class MetadataError(Exception):
+    pass
+
+# The fields required of a revision metadata object.
+metadata_keys = frozenset((
+    'pageid',
+    'title',
+    'url',
+    'revid',
+    'parentid',
+    'user',
+    'timestamp',
+    'comment'
+))
+
+# Discord rate-limits each webhook, so only a few records are reported at once.
+max_workers = 5
+
 def lambda_handler(event, context):
-    assert len(event['Records']) == 1
-    s3ev = event['Records'][0]['s3']
+    records = event['Records']
+    if not records:
+        return
+
+    # A failed invocation is retried with the whole event. Every record is
+    # fetched and validated before anything is posted, so a failure there is
+    # raised and can be retried without duplicating any message. Once posting
+    # has started, a retry would post the messages which went out again, so a
+    # failed post is only logged, unless no post succeeded at all.
+    workers = min(max_workers, len(records))
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        rvmetas = list(executor.map(fetch_record, records))
+        futures = [executor.submit(post_revision, rvmeta) for rvmeta in rvmetas]
+    errors = []
+    for rvmeta, future in zip(rvmetas, futures):
+        try:
+            future.result()
+        except Exception as e:
+            logger.exception(
+                'Failed to report revision %d of %s',
+                rvmeta['revid'],
+                rvmeta['title']
+            )
+            errors.append(e)
+    if len(errors) == len(rvmetas):
+        raise errors[0]
+
+def fetch_record(record):
+    """Downloads the revision metadata object an S3 event refers to."""
+    s3ev = record['s3']
     r = s3.get_object(
         Bucket=s3ev['bucket']['name'],
         Key=s3ev['object']['key']
     )
-    rvmeta = yaml.safe_load(r['Body'])
-    assert 'pageid' in rvmeta
-    assert 'title' in rvmeta
-    assert 'url' in rvmeta
-    assert 'revid' in rvmeta
-    assert 'parentid' in rvmeta
-    assert 'user' in rvmeta
-    assert 'timestamp' in rvmeta
-    assert 'comment' in rvmeta
+    rvmeta = yaml.load(r['Body'], Loader=SafeLoader)
+    missing = metadata_keys - rvmeta.keys()
+    if missing:
+        raise MetadataError(
+            'missing keys: {:s}'.format(', '.join(sorted(missing)))
+        )
+    return rvmeta
+
+def post_revision(rvmeta):
+    """Reports a revision to the Discord webhook."""
     if rvmeta['parentid'] == 0:
         desc = 'Page created.'
     else:
@@ -35,7 +115,7 @@ def lambda_handler(event, context):
     comment = rvmeta['comment']
     if comment == '':
         comment = '(no comment)'
-    requests.post(
+    session.post(
         os.environ['DISCORD_WEBHOOK'],
         params={
             'wait': 'true'
@@ -59,6 +139,5 @@ def lambda_handler(event, context):
                     ]
                 }
             ]
-        },
-        headers=req_headers
+        }
     ).raise_for_status()